@@ -1,18 +1,25 @@
 import os
 import re
-import shutil
+import asyncio
 import zipfile
 import datetime
 import hashlib
+import json
+import logging
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from io import BytesIO
-from typing import List, Optional
+from itertools import islice
+from typing import Dict, List, Optional
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Response, Depends
 from fastapi.responses import StreamingResponse
 from jose import jwt, JWTError
 from passlib.context import CryptContext
-from PIL import Image, ImageEnhance, ImageOps, ImageChops
-import numpy as np
+from PIL import Image, features
 
 # Database
 from sqlalchemy import create_engine, Column, Integer, String, Boolean
@@ -22,9 +29,31 @@ from sqlalchemy.orm import sessionmaker
 # Stripe
 import stripe
 
+from render import PLATFORM_SIZES, render_upload, warm_render_worker
+
 Image.MAX_IMAGE_PIXELS = 50_000_000
 
-app = FastAPI()
+logger = logging.getLogger("photobatcher")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # JPEG I/O is the hot path; make a build without libjpeg-turbo obvious.
+    if features.check_feature("libjpeg_turbo"):
+        logger.info("Pillow %s using libjpeg-turbo %s", Image.__version__, features.version("jpg"))
+    else:
+        logger.warning("Pillow %s is not linked against libjpeg-turbo; JPEG I/O will be slow", Image.__version__)
+
+    # Rendering is CPU-bound, so it runs in worker processes shared by all requests.
+    app.state.render_pool = await start_render_pool()
+    app.state.render_pool_lock = asyncio.Lock()
+    # Caps concurrent /process batches so large uploads queue instead of exhausting RAM.
+    app.state.batch_slots = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    try:
+        yield
+    finally:
+        app.state.render_pool.shutdown(wait=True, cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
 
 VERSION = "stripe-metadata-fix-v2"
 
@@ -39,6 +68,12 @@ STRIPE_PRICE_ID_ANNUAL = os.getenv("STRIPE_PRICE_ID_ANNUAL")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 JWT_SECRET = os.getenv("JWT_SECRET")
 JWT_EXPIRE_MINUTES = int(os.getenv("JWT_EXPIRE_MINUTES", "10080"))
+MAX_CONCURRENT_BATCHES = int(os.getenv("MAX_CONCURRENT_BATCHES", "2"))
+RENDER_CACHE_MB = int(os.getenv("RENDER_CACHE_MB", "256"))
+# os.cpu_count() reports the host's cores, not the ones this process may use.
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or (
+    len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+)
 
 required_envs = [
     DATABASE_URL,
@@ -117,13 +152,17 @@ def get_current_user(request: Request):
 # ROUTES
 # =====================================================
 
+# Static bodies, serialized once at import instead of on every hit.
+HOME_BODY = json.dumps({"status": "PhotoBatcher SaaS Running", "version": VERSION}).encode()
+VERSION_BODY = json.dumps({"version": VERSION}).encode()
+
 @app.get("/")
 async def home():
-    return {"status": "PhotoBatcher SaaS Running", "version": VERSION}
+    return Response(HOME_BODY, media_type="application/json")
 
 @app.get("/version")
 async def version():
-    return {"version": VERSION}
+    return Response(VERSION_BODY, media_type="application/json")
 
 # ========================
 # AUTH ROUTES
@@ -243,9 +282,139 @@ async def stripe_webhook(request: Request):
     return {"status": "success"}
 
 # ========================
-# PROCESS (UNCHANGED)
+# PROCESS
 # ========================
 
+_SLUG_STRIP = re.compile(r"[^A-Za-z0-9_\-]")
+_SLUG_COLLAPSE = re.compile(r"_+")
+
+def slugify_title(title: Optional[str]) -> str:
+    title = (title or "").strip().replace(" ", "_")
+    title = _SLUG_STRIP.sub("", title)
+    title = _SLUG_COLLAPSE.sub("_", title).strip("_")
+    return title or "Batch"
+
+async def start_render_pool() -> ProcessPoolExecutor:
+    # Spawned workers import only render.py; forked ones would inherit the
+    # app's DB connections and event-loop threads.
+    pool = ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=warm_render_worker,
+    )
+    # Start (and warm) every worker now rather than on the first upload.
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(pool, os.getpid) for _ in range(RENDER_WORKERS)))
+    return pool
+
+async def replace_render_pool(app: FastAPI, broken: ProcessPoolExecutor) -> ProcessPoolExecutor:
+    # A dead worker (e.g. OOM-killed) breaks the pool for good. The lock makes
+    # requests that hit the same broken pool share one replacement.
+    async with app.state.render_pool_lock:
+        if app.state.render_pool is broken:
+            logger.warning("Render worker died; restarting the render pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            app.state.render_pool = await start_render_pool()
+        return app.state.render_pool
+
+class RenderCache:
+    """Byte-bounded LRU of rendered JPEGs, keyed by upload digest and sizes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key):
+        jpegs = self._entries.get(key)
+        if jpegs is not None:
+            self._entries.move_to_end(key)
+        return jpegs
+
+    def put(self, key, jpegs: Dict[int, bytes]):
+        size = sum(map(len, jpegs.values()))
+        if size > self.max_bytes or key in self._entries:
+            return
+
+        self._entries[key] = jpegs
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= sum(map(len, evicted.values()))
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_MB * 1024 * 1024)
+
+def upload_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def probe_image(fp) -> None:
+    # Parses the header only; no pixel data is decoded.
+    try:
+        with Image.open(fp):
+            pass
+    finally:
+        fp.seek(0)
+
+class ZipChunkBuffer:
+    """Unseekable sink, so zipfile streams and output can be drained as written."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+class BatchSlot:
+    """Holds a batch_slots slot only while the request has renders in flight."""
+
+    def __init__(self, slots: asyncio.Semaphore):
+        self._slots = slots
+        self._lock = asyncio.Lock()
+        self._active = 0
+        self._held = False
+
+    async def acquire(self):
+        async with self._lock:
+            if not self._held:
+                await self._slots.acquire()
+                self._held = True
+
+    def release(self):
+        if self._held and not self._active:
+            self._held = False
+            self._slots.release()
+
+    @asynccontextmanager
+    async def rendering(self):
+        await self.acquire()
+        self._active += 1
+        try:
+            yield
+        finally:
+            self._active -= 1
+            self.release()
+
+class BatchResponse(StreamingResponse):
+    def __init__(self, content, batch: BatchSlot, **kwargs):
+        super().__init__(content, **kwargs)
+        self.batch = batch
+
+    async def __call__(self, scope, receive, send):
+        # The body iterator may never start, so stream_zip() can't be relied on.
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.batch.release()
+
 @app.post("/process")
 async def process(
     request: Request,
@@ -264,51 +433,94 @@ async def process(
     if len(files) > 24:
         raise HTTPException(400, "Maximum 24 images")
 
-    title = (item_title or "Batch").replace(" ", "_")
-    date = datetime.datetime.now().strftime("%Y-%m-%d")
-
-    UPLOAD_DIR = f"temp/{user.id}/uploads"
-    PROCESSED_DIR = f"temp/{user.id}/processed"
-
-    if os.path.exists(f"temp/{user.id}"):
-        shutil.rmtree(f"temp/{user.id}")
+    title = slugify_title(item_title)
+    now = datetime.datetime.now()
+    date = now.strftime("%Y-%m-%d")
+
+    platforms = list(dict.fromkeys(platforms))
+    unknown = [p for p in platforms if p not in PLATFORM_SIZES]
+    if unknown:
+        raise HTTPException(400, f"Unknown platform: {', '.join(unknown)}")
+
+    # A later upload with the same name replaces an earlier one.
+    uploads = {os.path.splitext(os.path.basename(f.filename))[0]: f for f in files}
+    targets = [PLATFORM_SIZES[platform] for platform in platforms]
+    # Output depends only on the set of sizes (chained resizes run largest
+    # first), not the order platforms were picked in.
+    sizes = sorted(set(targets))
+
+    # Once the ZIP is streaming, a decode error can only cut the download short.
+    async def check(upload: UploadFile):
+        try:
+            await asyncio.to_thread(probe_image, upload.file)
+        except (OSError, Image.DecompressionBombError):
+            raise HTTPException(400, f"Unsupported image: {upload.filename}")
+
+    await asyncio.gather(*(check(upload) for upload in uploads.values()))
+
+    loop = asyncio.get_running_loop()
+
+    async def render(upload: UploadFile) -> List[bytes]:
+        async with batch.rendering():
+            data = await upload.read()
+            key = (await asyncio.to_thread(upload_digest, data), tuple(sizes))
+
+            jpegs = RENDER_CACHE.get(key)
+            if jpegs is None:
+                pool = request.app.state.render_pool
+                try:
+                    jpegs = await loop.run_in_executor(pool, render_upload, data, sizes)
+                except BrokenProcessPool:
+                    # Retry once; if this upload killed the worker, let it fail.
+                    pool = await replace_render_pool(request.app, pool)
+                    jpegs = await loop.run_in_executor(pool, render_upload, data, sizes)
+                RENDER_CACHE.put(key, jpegs)
+            return [jpegs[size] for size in targets]
 
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    os.makedirs(PROCESSED_DIR, exist_ok=True)
-
-    sizes = {"ebay": 1600, "poshmark": 1080, "mercari": 1200}
-
-    for f in files:
-        with open(os.path.join(UPLOAD_DIR, f.filename), "wb") as buffer:
-            buffer.write(await f.read())
-
-    for platform in platforms:
-        folder = os.path.join(PROCESSED_DIR, platform)
-        os.makedirs(folder, exist_ok=True)
-
-        for name in os.listdir(UPLOAD_DIR):
-            with Image.open(os.path.join(UPLOAD_DIR, name)) as img:
-                img = ImageOps.exif_transpose(img)
-                img = img.convert("RGB")
-                img = img.resize((sizes[platform], sizes[platform]), Image.LANCZOS)
-
-                base, _ = os.path.splitext(name)
-                img.save(os.path.join(folder, base + ".jpg"), "JPEG", quality=85)
-
-    zip_buffer = BytesIO()
     parent = f"{title}_PhotoBatcher_{date}"
 
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files_on_disk in os.walk(PROCESSED_DIR):
-            for f in files_on_disk:
-                full = os.path.join(root, f)
-                rel = os.path.relpath(full, PROCESSED_DIR)
-                zipf.write(full, os.path.join(parent, rel))
-
-    zip_buffer.seek(0)
-
-    return StreamingResponse(
-        zip_buffer,
+    async def stream_zip():
+        # Render at most `window` uploads ahead of the writer, so a slow
+        # download can't pile the whole batch up in memory.
+        window = RENDER_WORKERS
+        pending = iter(uploads.items())
+        jobs = deque()
+
+        def schedule():
+            for base, upload in islice(pending, window - len(jobs)):
+                jobs.append((base, asyncio.create_task(render(upload))))
+
+        sink = ZipChunkBuffer()
+        try:
+            # JPEGs don't deflate; storing them saves the CPU.
+            with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zipf:
+                schedule()
+                while jobs:
+                    base, job = jobs.popleft()
+                    jpegs = await job
+                    schedule()
+                    for platform, jpeg in zip(platforms, jpegs):
+                        entry = zipfile.ZipInfo(f"{parent}/{platform}/{base}.jpg", date_time=now.timetuple()[:6])
+                        entry.compress_type = zipfile.ZIP_STORED
+                        # writestr() would default str names to 0600.
+                        entry.external_attr = 0o644 << 16
+                        zipf.writestr(entry, jpeg)
+                    yield sink.drain()
+            yield sink.drain()
+        finally:
+            for _, job in jobs:
+                job.cancel()
+                # Retrieve failures so asyncio doesn't log them as unhandled.
+                job.add_done_callback(lambda job: job.cancelled() or job.exception())
+            batch.release()
+
+    # Queue before any headers go out rather than hang on a 200 with no body.
+    batch = BatchSlot(request.app.state.batch_slots)
+    await batch.acquire()
+
+    return BatchResponse(
+        stream_zip(),
+        batch,
         media_type="application/zip",
         headers={"Content-Disposition": f'attachment; filename="{parent}.zip"'},
     )
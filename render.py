@@ -0,0 +1,61 @@
+from io import BytesIO
+from typing import Dict, List
+
+from PIL import Image, ImageOps
+
+# Only what the render pool runs, so spawned workers import Pillow, not the app.
+
+def encode_jpeg(img: Image.Image) -> bytes:
+    out = BytesIO()
+    img.save(out, "JPEG", quality=85)
+    return out.getvalue()
+
+# Square output edge, in pixels, for each marketplace.
+PLATFORM_SIZES = {"ebay": 1600, "poshmark": 1080, "mercari": 1200}
+
+ORIENTATION_TAG = 0x0112
+
+def resize_square(img: Image.Image, size: int) -> Image.Image:
+    if img.size == (size, size):
+        return img
+
+    # Up to 2x, bicubic matches Lanczos once encoded at Q85. render_upload()
+    # leaves sources under 4x, so reducing_gap only kicks in past 6x (e.g. a
+    # panorama's long side).
+    resample = Image.BICUBIC if max(img.size) <= 2 * size else Image.LANCZOS
+    return img.resize((size, size), resample, reducing_gap=3.0)
+
+def render_upload(data: bytes, sizes: List[int]) -> Dict[int, bytes]:
+    # Runs in the render pool, so keep it top-level and picklable.
+    with Image.open(BytesIO(data)) as img:
+        # JPEG shrink-on-load at 1/2, 1/4 or 1/8 scale, never below the target.
+        largest = max(sizes)
+        img.draft("RGB", (largest, largest))
+        # draft() already yields RGB for colour JPEGs; convert() would still copy.
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        # draft() is a no-op for PNG/WebP/etc. This leaves the short side under
+        # 4x the largest target (2x-3x when reduced).
+        factor = min(img.size) // (2 * largest)
+        if factor >= 2:
+            img = img.reduce(factor)
+
+        # exif_transpose() copies even when no rotation is needed.
+        if img.getexif().get(ORIENTATION_TAG, 1) != 1:
+            img = ImageOps.exif_transpose(img)
+
+        # Chain resizes largest-first so only the first reads the full image.
+        # Stays inside the with block: img may still be the opened file.
+        rendered = {}
+        for size in sorted(set(sizes), reverse=True):
+            img = resize_square(img, size)
+            rendered[size] = encode_jpeg(img)
+
+    return rendered
+
+def warm_render_worker():
+    # Pool initializer: load codecs and resample paths before real uploads.
+    sample = BytesIO()
+    Image.new("RGB", (64, 64), "white").save(sample, "JPEG")
+    render_upload(sample.getvalue(), list(PLATFORM_SIZES.values()))
@@ -0,0 +1,37 @@
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# main.py validates its environment and creates the database tables at import
+# time, so point it at a throwaway SQLite file before anything imports it.
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/test.db"
+for name in (
+    "STRIPE_SECRET_KEY",
+    "STRIPE_PRICE_ID_MONTHLY",
+    "STRIPE_PRICE_ID_ANNUAL",
+    "STRIPE_WEBHOOK_SECRET",
+    "JWT_SECRET",
+):
+    os.environ[name] = "test"
+
+import main
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def subscriber_cookie():
+    db = main.SessionLocal()
+    user = main.User(email=f"{uuid.uuid4().hex}@example.com", password_hash="x", subscription_active=True)
+    db.add(user)
+    db.commit()
+    token = main.create_token(user.id)
+    db.close()
+    return f"{main.COOKIE_NAME}={token}"
@@ -0,0 +1,64 @@
+import asyncio
+from io import BytesIO
+
+import httpx
+import pytest
+from PIL import Image
+from starlette.requests import ClientDisconnect
+
+import main
+
+
+def process_scope(cookie):
+    image = BytesIO()
+    Image.new("RGB", (64, 64), "white").save(image, "JPEG")
+    request = httpx.Request(
+        "POST",
+        "http://testserver/process",
+        files=[("files", ("a.jpg", image.getvalue(), "image/jpeg"))],
+        data={"platforms": "ebay"},
+        headers={"cookie": cookie},
+    )
+    body = request.read()
+    scope = {
+        "type": "http",
+        # Starlette lets send() errors escape on ASGI 2.4 servers instead of
+        # watching for http.disconnect.
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/process",
+        "raw_path": b"/process",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in request.headers.items()],
+        "client": ("testclient", 50000),
+        "server": ("testserver", 80),
+    }
+    return scope, body
+
+
+def test_slot_released_when_response_start_fails(client, subscriber_cookie):
+    scope, body = process_scope(subscriber_cookie)
+
+    async def request_once():
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                raise OSError("client went away")
+
+        with pytest.raises((OSError, ClientDisconnect)):
+            await main.app(scope, receive, send)
+
+    async def run():
+        # A leaked slot would leave the last of these waiting forever.
+        for _ in range(main.MAX_CONCURRENT_BATCHES + 1):
+            await asyncio.wait_for(request_once(), timeout=10)
+
+    client.portal.call(run)
+    assert main.app.state.batch_slots._value == main.MAX_CONCURRENT_BATCHES
@@ -0,0 +1,63 @@
+from io import BytesIO
+
+from PIL import Image
+
+import main
+from main import RenderCache, upload_digest
+
+
+def test_byte_bound_evicts_oldest():
+    cache = RenderCache(max_bytes=10)
+    cache.put("a", {1080: b"aaaa"})
+    cache.put("b", {1080: b"bbbb"})
+    cache.put("c", {1080: b"cccc"})
+
+    assert cache.get("a") is None
+    assert cache.get("b") == {1080: b"bbbb"}
+    assert cache.get("c") == {1080: b"cccc"}
+
+
+def test_get_refreshes_recency():
+    cache = RenderCache(max_bytes=10)
+    cache.put("a", {1080: b"aaaa"})
+    cache.put("b", {1080: b"bbbb"})
+    cache.get("a")
+    cache.put("c", {1080: b"cccc"})
+
+    assert cache.get("b") is None
+    assert cache.get("a") == {1080: b"aaaa"}
+
+
+def test_entry_larger_than_cache_is_not_stored():
+    cache = RenderCache(max_bytes=10)
+    cache.put("a", {1080: b"aaaa"})
+    cache.put("big", {1080: b"x" * 11})
+
+    assert cache.get("big") is None
+    assert cache.get("a") == {1080: b"aaaa"}
+
+
+def test_size_sets_do_not_collide():
+    cache = RenderCache(max_bytes=100)
+    digest = upload_digest(b"photo")
+    cache.put((digest, (1080,)), {1080: b"small"})
+    cache.put((digest, (1080, 1600)), {1080: b"small", 1600: b"large"})
+
+    assert cache.get((digest, (1080,))) == {1080: b"small"}
+    assert cache.get((digest, (1080, 1600))) == {1080: b"small", 1600: b"large"}
+    assert cache.get((upload_digest(b"other"), (1080,))) is None
+
+
+def test_platform_order_shares_cache_entry(client, subscriber_cookie):
+    image = BytesIO()
+    Image.new("RGB", (300, 200), "red").save(image, "JPEG")
+    files = [("files", ("order.jpg", image.getvalue(), "image/jpeg"))]
+    client.headers["cookie"] = subscriber_cookie
+
+    first = client.post("/process", files=files, data={"platforms": ["ebay", "mercari"]})
+    entries = len(main.RENDER_CACHE._entries)
+    second = client.post("/process", files=files, data={"platforms": ["mercari", "ebay"]})
+
+    assert first.status_code == second.status_code == 200
+    assert first.content.count(b"order.jpg") == second.content.count(b"order.jpg")
+    assert len(main.RENDER_CACHE._entries) == entries